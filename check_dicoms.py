@@ -2,43 +2,93 @@
 # coding: utf-8
 
 import os
-import json
+import sys
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 
 import pydicom as dcm
+from pydicom.multival import MultiValue
+from pydicom.tag import Tag
+
+from scrub_dicoms import SCRUB_TAGS, iter_dicoms
+
+# Only these tags are read from each DICOM header, the remaining elements are skipped.
+# Private data elements (element 0x1000 and up) also need their private creator, otherwise
+# implicit VR values cannot be decoded. Private creator tags themselves have no creator
+SPECIFIC_TAGS = sorted({tag for field_name, tag in SCRUB_TAGS}
+                       | {Tag(tag.group, tag.element >> 8) for field_name, tag in SCRUB_TAGS
+                          if tag.is_private and tag.element >= 0x1000})
+
+def check_dicom(dicom_file):
+    """
+    Collects the values of the fields to scrub found in a single DICOM file.
+
+    Args:
+        dicom_file (str): Path to the DICOM file.
+
+    Returns:
+        dict: Maps each field name found in the file to a set of its values.
+    """
+    field_values = {}
+    # Report errors per file instead of raising them, so the remaining files are still checked
+    try:
+        with open(dicom_file, 'rb') as f:
+            # Empty files hold no fields to collect
+            if os.fstat(f.fileno()).st_size == 0:
+                return field_values
+
+            # Read only the header through the buffered file, the rest of the file is never needed
+            dicom_data = dcm.dcmread(f, force=True, specific_tags=SPECIFIC_TAGS,
+                                     stop_before_pixels=True, defer_size=1024)
+
+            # Iterate through fields to scrub and collect values found in the DICOM header
+            # Test the integer tags against the dataset's keys, rather than through
+            # Dataset.__contains__ which builds a new Tag on every call
+            dicom_tags = dicom_data.keys()
+            for field_name, tag in SCRUB_TAGS:
+                if tag in dicom_tags:
+                    value = dicom_data[tag].value
+                    if isinstance(value, dcm.Sequence):
+                        # Datasets are not hashable, so sequences are kept as their text
+                        value = str(value)
+                    elif isinstance(value, MultiValue):
+                        # Store values with multiplicity as tuples so they can be added to the set
+                        value = tuple(value)
+                    field_values.setdefault(field_name, set()).add(value)
+    except Exception as error:
+        print(f'DICOM file: {dicom_file} could not be checked: {error!r}')
+
+    return field_values
 
 def check_dicoms(session_path):
+    if not os.path.isdir(session_path):
+        print(f'{session_path} is not a directory.')
+        return
+
     print(f'Checking {session_path} for DICOMs...')
 
     dicom_output_dict = {}
-    for field_tag, field_name in scrub_field_dict.items():
+    for field_name, tag in SCRUB_TAGS:
         dicom_output_dict[field_name] = set()
 
     num_dicoms = 0
-    # Iterate through all files and subdirectories within the session path
-    for path, subdirs, files in os.walk(session_path):
-        for file in [dicom for dicom in files if dicom.endswith('.dcm')]:
+    # Checking only reads headers, so threads overlap the file I/O without pickling results between processes.
+    # The values found in each file are merged here in the main thread.
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        for field_values in executor.map(check_dicom, iter_dicoms(session_path)):
             num_dicoms += 1
-            dicom_data = dcm.dcmread(os.path.join(path, file), force=True)
-            # Iterate through fields in the scrub_field_dict and print values
-            for field_tag, field_name in scrub_field_dict.items():
-                # Convert hexadecimal values to integers and check for field in the DICOM header
-                x, y = map(lambda val: int(val, base=16), field_tag.split(","))
-                if (x, y) in dicom_data:
-                    # Obtain the field value and append if new:
-                    dicom_output_dict[field_name].add(dicom_data[(x, y)].value)
-
-    print(f'{num_dicoms} DICOMs found: \n')
+            for field_name, values in field_values.items():
+                dicom_output_dict[field_name].update(values)
+
+    # Write the report in a single call rather than a print per field
+    report = [f'{num_dicoms} DICOMs found: \n\n']
     for field_name, value_list in dicom_output_dict.items():
         field_vals = str(list(value_list))
-        print(f'{field_name}: {field_vals}')
+        report.append(f'{field_name}: {field_vals}\n')
+    sys.stdout.write(''.join(report))
 
 if __name__ == "__main__":
-    
-    script_dir = os.path.abspath(os.path.dirname(__file__))
-    with open(f'{script_dir}/id_fields.json', 'r') as json_file:
-        scrub_field_dict = json.load(json_file)
-    
+
     parser = argparse.ArgumentParser(description='Check DICOM fields.')
     parser.add_argument('scan_session_directory', nargs='?', default='.', help='Path to the directory containing DICOM files')
 
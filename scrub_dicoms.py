@@ -2,12 +2,65 @@
 # coding: utf-8
 
 import argparse
+import functools
 import os
 import json
-import random
-import string
+import re
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
 
 import pydicom as dcm
+from pydicom.datadict import dictionary_has_tag
+from pydicom.tag import Tag
+
+def load_scrub_tags(json_path):
+    """
+    Loads the fields to scrub and converts their hexadecimal tags to integer DICOM tags.
+
+    Args:
+        json_path (str): Path to the JSON file mapping "group,element" tags to field names.
+
+    Returns:
+        tuple: (field name, tag) pairs for each field to scrub, sorted by tag.
+    """
+    with open(json_path, 'r') as json_file:
+        scrub_field_dict = json.load(json_file)
+
+    scrub_tags = ((field_name, Tag(*(int(val, base=16) for val in field_tag.split(","))))
+                  for field_tag, field_name in scrub_field_dict.items())
+    return tuple(sorted(scrub_tags, key=lambda field: field[1]))
+
+# Loaded once at import so that worker processes have the scrub fields as well
+script_dir = os.path.abspath(os.path.dirname(__file__))
+SCRUB_TAGS = load_scrub_tags(os.path.join(script_dir, 'id_fields.json'))
+
+# Field name for each tag to scrub, looked up while traversing a DICOM header
+SCRUB_FIELDS = {tag: field_name for field_name, tag in SCRUB_TAGS}
+
+# Keyword for each tag whose value is used in the new filename
+METADATA_TAGS = {
+    Tag(0x0008, 0x0060): "Modality",
+    Tag(0x0020, 0x000E): "SeriesInstanceUID",
+    Tag(0x0020, 0x0013): "InstanceNumber",
+}
+
+# All tags looked up while traversing a DICOM header. Tags are traversed in ascending
+# order, so none of them comes after the last one
+HEADER_TAGS = frozenset(SCRUB_FIELDS).union(METADATA_TAGS)
+LAST_HEADER_TAG = max(HEADER_TAGS)
+
+# De-identified value for each handled Value Representation (VR)
+VR_REPLACEMENTS = {}
+# String types
+VR_REPLACEMENTS.update({vr: 'REDACTED' for vr in ("LO", "SH", "PN", "LT", "ST", "UT", "TM", "DT", "CS", "UI")})
+# Integer types
+VR_REPLACEMENTS.update({vr: 0 for vr in ("IS", "SL", "SS", "UL", "US")})
+# Decimal types
+VR_REPLACEMENTS.update({vr: 0.0 for vr in ("DS", "FD", "FL")})
+# Other byte types
+VR_REPLACEMENTS.update({vr: bytes('REDACTED', 'utf-8') for vr in ("OB", "OW", "UN")})
+# Dates
+VR_REPLACEMENTS['DA'] = '00010101'
 
 def vr_scrub(tag, vr):
     """
@@ -22,52 +75,56 @@ def vr_scrub(tag, vr):
             - For integer types (IS, SL, SS, UL, US), returns 0.
             - For decimal types (DS, FD, FL), returns 0.0.
             - For other byte types (OB, OW, UN), returns bytes('REDACTED', 'utf-8').
+            - For dates (DA), returns '00010101'.
     """
-    
-    if vr in ["LO", "SH", "PN", "LT", "ST", "UT", "TM", "DT", "CS", "UI"]:
-        # The VR is a string type
-        return('REDACTED')
-    elif vr in  ["IS", "SL", "SS", "UL", "US"]:
-        # The VR is an integer type
-        return(0)
-    elif vr in ["DS", "FD", "FL"]:
-        # The VR is a decimal type
-        return(0.0)
-    elif vr in ["OB", "OW", "UN"]:
-        # The VR is other byte
-        return(bytes('REDACTED', 'utf-8'))
-    elif vr == 'DA':
-        # The VR is a date
-        return('00010101')
-    else:
-        print(f"The tag {tag} has VR {vr}, which is not handled by this function.")
-
-def avoid_duplicates(path, counter=0):
-    """
-    Generate a unique filename by appending an increasing counter if the filename already exists.
+    if vr in VR_REPLACEMENTS:
+        return VR_REPLACEMENTS[vr]
+
+    print(f"The tag {tag} has VR {vr}, which is not handled by this function.")
+
+def is_dicom(dicom_data):
+    """
+    Checks whether a dataset read with force=True actually came from DICOM data.
 
     Args:
-        file_path (str): The original file path.
-        counter (int, optional): Counter for appending numbers. Defaults to 0.
+        dicom_data (pydicom.dataset.FileDataset): The dataset read from the file.
 
     Returns:
-        str: Unique filename.
+        bool: True if the file has File Meta Information with a Transfer Syntax UID, or
+            otherwise contains at least one tag known to the DICOM data dictionary.
+    """
+    if "TransferSyntaxUID" in dicom_data.file_meta:
+        return True
+
+    # Files without a preamble and file meta can still be DICOM datasets
+    return any(dictionary_has_tag(tag) for tag in dicom_data.keys())
+
+def avoid_duplicates(path):
     """
-    if counter == 0:
-        # Base case: check if the file already exists
-        if not os.path.exists(path):
-            return path
+    Reserve a unique filename by appending an increasing counter if the filename already exists.
 
-    # Generate a new filename by appending the counter
-    new_path = f"{os.path.splitext(path)[0]}_{counter}{os.path.splitext(path)[1]}"
+    The file is created empty with O_CREAT | O_EXCL, so concurrent workers can never reserve
+    the same filename.
 
-    # Check if the new filename already exists
-    if os.path.exists(new_path):
-        # If it exists, recursively call the function with an incremented counter
-        return unique_filename(file_path, counter + 1)
-    else:
-        # If it doesn't exist, return the new filename
-        return new_path
+    Args:
+        path (str): The original file path.
+
+    Returns:
+        str: Unique file path, which now exists as an empty file.
+    """
+    root, ext = os.path.splitext(path)
+    new_path = path
+    counter = 0
+    while True:
+        try:
+            fd = os.open(new_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            # Generate a new filename by appending the counter and try again
+            new_path = f"{root}_{counter}{ext}"
+            counter += 1
+        else:
+            os.close(fd)
+            return new_path
 
 def remove_identifiers_from_dicom(dicom_file, subject_id=None):
     """
@@ -77,38 +134,135 @@ def remove_identifiers_from_dicom(dicom_file, subject_id=None):
         dicom_file (str): Path to the DICOM file.
         subject_id (str, optional): New subject ID to assign. Defaults to None.
     """
-    dicom_data = dcm.dcmread(dicom_file, force=True)
-    
-    # Extract DICOM metadata for filename
-    modality = dicom_data.get("Modality","NA")
-    seriesInstanceUID = dicom_data.get("SeriesInstanceUID","NA")
-    instanceNumber = str(dicom_data.get("InstanceNumber","0"))
-
-    # Generate a new filename based on DICOM metadata and a random suffix (sometimes two dicoms will have the same UID and instance number)
-    filename = dicom_file.split('/')[-1]
-    new_filename = avoid_duplicates(modality + "." + seriesInstanceUID + "." + instanceNumber + ".dcm")
-    
-    # Iterate through fields to scrub, specified by the id_fields.json file
-    for field_tag, field_name in scrub_field_dict.items():
-        # Convert hexadecimal values to integers
-        x, y = map(lambda val: int(val, base=16), field_tag.split(","))
-    
-        # Check if field exists in DICOM data
-        if (x, y) in dicom_data:
-            value_rep = dicom_data[(x, y)].VR
-            # Scrub the value
-            dicom_data[(x, y)].value = vr_scrub(field_name, value_rep)
-    
+    # Read the whole file in one call, as its pixel data is copied when saving anyway. Unlike a
+    # memory map, a BytesIO also allows seeking past the end of truncated files
+    with open(dicom_file, 'rb') as f:
+        dicom_bytes = f.read()
+
+    # Empty files hold no DICOM data to scrub
+    if not dicom_bytes:
+        print(f'DICOM file: {dicom_file} missing key fields for saving.')
+        return
+
+    # Large values such as the pixel data are deferred and copied unchanged from memory when saving
+    dicom_data = dcm.dcmread(BytesIO(dicom_bytes), force=True, defer_size=1024)
+
+    # Leave files that are not DICOM data untouched, rather than renaming or rewriting them
+    if not is_dicom(dicom_data):
+        print(f'DICOM file: {dicom_file} missing key fields for saving.')
+        return
+
+    # Traverse the DICOM header once, extracting the metadata for the filename and
+    # scrubbing the fields specified by the id_fields.json file
+    metadata = {}
+    modified = False
+    remaining = set(HEADER_TAGS)
+    for tag in sorted(dicom_data.keys()):
+        if tag > LAST_HEADER_TAG:
+            break
+        if tag not in remaining:
+            continue
+        if tag in METADATA_TAGS:
+            metadata[METADATA_TAGS[tag]] = dicom_data[tag].value
+        if tag in SCRUB_FIELDS:
+            # Replace the element without decoding its original value, taking the VR from
+            # the raw element unless the file uses implicit VR
+            value_rep = dicom_data.get_item(tag).VR or dicom_data[tag].VR
+            dicom_data[tag] = dcm.DataElement(tag, value_rep, vr_scrub(SCRUB_FIELDS[tag], value_rep))
+            modified = True
+        remaining.discard(tag)
+        # Stop once every tag has been found
+        if not remaining:
+            break
+
+    modality = metadata.get("Modality","NA")
+    seriesInstanceUID = metadata.get("SeriesInstanceUID","NA")
+    instanceNumber = str(metadata.get("InstanceNumber","0"))
+
+    # Generate a new filename based on DICOM metadata and a counter suffix if the name is taken (sometimes two dicoms will have the same UID and instance number)
+    new_filename = modality + "." + seriesInstanceUID + "." + instanceNumber + ".dcm"
+
     # Assign new subject ID if provided
     if subject_id:
         dicom_data.PatientID = subject_id
-                
-    # Save modified DICOM data to file and rename
+        modified = True
+
+    # Save modified DICOM data to a temporary file
+    tmp_file = dicom_file + '.tmp'
+    if modified:
+        try:
+            dicom_data.save_as(tmp_file, write_like_original=True)
+        except ValueError:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            print(f'DICOM file: {dicom_file} missing key fields for saving.')
+            return
+
+    # Already named after its metadata, with or without the counter suffix added by
+    # avoid_duplicates (e.g. scrubbed before), so it keeps its name
+    root, ext = os.path.splitext(new_filename)
+    if re.fullmatch(re.escape(root) + r'(_\d+)?' + re.escape(ext), os.path.basename(dicom_file)):
+        if modified:
+            os.replace(tmp_file, dicom_file)
+        return
+
+    # Reserve the new filename only once the file is ready to be moved, and drop the
+    # reservation again if the move does not happen
+    new_path = avoid_duplicates(os.path.join(os.path.dirname(dicom_file), new_filename))
+    moved = False
     try:
-        dicom_data.save_as(dicom_file, write_like_original=False)
-        os.rename(dicom_file, dicom_file.replace(filename, new_filename))
-    except ValueError:
-        print(f'DICOM file: {dicom_file} missing key fields for saving.')
+        # If there was nothing to scrub, the original file is only renamed
+        os.replace(tmp_file if modified else dicom_file, new_path)
+        moved = True
+    finally:
+        if not moved:
+            os.remove(new_path)
+
+    if modified:
+        os.remove(dicom_file)
+
+def scrub_dicom(dicom_file, subject_id=None):
+    """
+    Scrubs a single DICOM file, reporting any error instead of raising it so the remaining files are still scrubbed.
+
+    Args:
+        dicom_file (str): Path to the DICOM file.
+        subject_id (str, optional): New subject ID to assign. Defaults to None.
+
+    Returns:
+        bool: Whether the file was processed without error.
+    """
+    try:
+        remove_identifiers_from_dicom(dicom_file, subject_id=subject_id)
+    except Exception as error:
+        print(f'DICOM file: {dicom_file} could not be scrubbed: {error!r}')
+        return False
+    return True
+
+def iter_dicoms(path):
+    """
+    Recursively yields the paths of all files ending with '.dcm' within a directory.
+
+    Args:
+        path (str): Path to the directory to search.
+
+    Yields:
+        str: Path to a DICOM file.
+    """
+    # List the whole directory before yielding, so files renamed meanwhile are not picked up
+    try:
+        with os.scandir(path) as it:
+            entries = list(it)
+    except OSError:
+        # Skip directories that cannot be read, as os.walk does
+        print(f'Directory: {path} could not be read, skipping.')
+        return
+
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            yield from iter_dicoms(entry.path)
+        elif entry.name.endswith('.dcm'):
+            yield entry.path
 
 def scrub_dicoms(session_path, subject_id=None):
     """
@@ -118,27 +272,29 @@ def scrub_dicoms(session_path, subject_id=None):
         session_path (str): Path to the scan session / directory containing DICOM files.
         subject_id (str, optional): New subject ID to assign. Defaults to None.
     """
+    if not os.path.isdir(session_path):
+        print(f'{session_path} is not a directory.')
+        return
+
     print(f'Scrubbing DICOM Files in {session_path}\n')
     
     dicom_number = 0
-    
-    # Iterate through all files and subdirectories within the session path
-    for path, subdirs, files in os.walk(session_path):
-
-        # Iterate through files ending with '.dcm'
-        for file in [dicom for dicom in files if dicom.endswith('.dcm')]:
-            
-            # Scrub DICOM file
-            remove_identifiers_from_dicom(dicom_file = os.path.join(path, file), subject_id=subject_id)
-            dicom_number += 1
+    failed_number = 0
+    # Scrub all DICOM files within the session path in parallel. Errors are reported per file,
+    # so one bad file does not stop the others in its chunk from being scrubbed
+    with ProcessPoolExecutor() as executor:
+        for scrubbed in executor.map(functools.partial(scrub_dicom, subject_id=subject_id),
+                                     iter_dicoms(session_path), chunksize=32):
+            if scrubbed:
+                dicom_number += 1
+            else:
+                failed_number += 1
 
     print(f'{dicom_number} DICOM files scrubbed from the parent directory {session_path}\n')
+    if failed_number:
+        print(f'{failed_number} DICOM files could not be scrubbed, see the errors above.\n')
 
 if __name__ == "__main__":
-    
-    script_dir = os.path.abspath(os.path.dirname(__file__))
-    with open(f'{script_dir}/id_fields.json', 'r') as json_file:
-        scrub_field_dict = json.load(json_file)
 
     parser = argparse.ArgumentParser(description='Scrub identifying information from DICOM files.')
     parser.add_argument('scan_session_directory', nargs='?', default='.', help='Path to the directory containing DICOM files')